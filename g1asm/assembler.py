@@ -10,15 +10,20 @@ import sys
 import os
 import json
 from enum import Enum
-from typing import Literal
+from typing import Literal, BinaryIO
 import argparse
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import re
-from rply import LexerGenerator, Token, LexingError
-from rply.lexer import LexerStream
+import mmap
+from array import array
+from contextlib import nullcontext
+try:
+    import orjson
+except ImportError:
+    orjson = None
 from g1asm.data import parse_entry, G1ADataException
-from g1asm.binary_format import G1BinaryFormat, ARG_TYPE_LITERAL, ARG_TYPE_ADDRESS, OPCODE_LOOKUP
-from g1asm.instructions import INSTRUCTIONS, ARGUMENT_COUNT_LOOKUP, ASSIGNMENT_INSTRUCTIONS
+from g1asm.binary_format import G1BinaryFormat, ARG_TYPE_LITERAL, ARG_TYPE_ADDRESS
+from g1asm.instructions import INSTRUCTION_INFO, IDENTITY_OPERANDS
 
 
 DEFAULT_META_VARS = {
@@ -34,29 +39,184 @@ DEFAULT_OUTPUT_FORMAT = 'json'
 INT_RANGE_LOWER = -2**31
 INT_RANGE_UPPER = 2**31-1
 
+# Placeholder argument for labels until resolve_labels fills them in
+PENDING_LABEL = object()
+
 COLOR_ERROR = '\x1b[31m'
 COLOR_WARN = '\x1b[33m'
 COLOR_RESET = '\x1b[0m'
 
-DATA_ENTRY_REGEX = r'@(\d+)\s+(file|bytes|string)\s+(raw|pack|img)\s+([\'\"\`])(.*)\4'
+DATA_ENTRY_REGEX = r'@(\d+)\s+(file|bytes|string)\s+(raw|pack|img)\s+(?P<quote>[\'\"\`])(.*)(?P=quote)'
+
+KIND_NUMBER = 0
+KIND_ADDRESS = 1
+KIND_NAME = 2
+KIND_LABEL_NAME = 3
+KIND_META_VARIABLE = 4
+KIND_COMMENT = 5
+KIND_NEWLINE = 6
+KIND_DATA_ENTRY = 7
+KIND_WHITESPACE = 8
+KIND_UNKNOWN = 9
+
+# Indexed by token kind
+KIND_NAMES = ['NUMBER', 'ADDRESS', 'NAME', 'LABEL_NAME', 'META_VARIABLE', 'COMMENT', 'NEWLINE', 'DATA_ENTRY', 'WHITESPACE', 'UNKNOWN']
+
+# Token patterns in match priority order. Whitespace is skipped and anything
+# that falls through to UNKNOWN is a lexing error.
+TOKEN_PATTERNS = [
+    (KIND_META_VARIABLE, r'#[A-Za-z]+'),
+
+    (KIND_NUMBER, r'-?\d+'),
+    (KIND_ADDRESS, r'\$\d+'),
+    (KIND_LABEL_NAME, r'[A-Za-z0-9_]+:'),
+    (KIND_NAME, r'[A-Za-z_][A-Za-z0-9_]*'),
+
+    (KIND_DATA_ENTRY, DATA_ENTRY_REGEX),
+
+    (KIND_COMMENT, r';[^\n]*'),
+    (KIND_NEWLINE, r'\n'),
+    (KIND_WHITESPACE, r'[ \t\r]+'),
+    (KIND_UNKNOWN, r'.'),
+]
+# Compiled as a bytes pattern so it can scan a memory mapped source file directly
+TOKEN_REGEX = re.compile('|'.join(f'(?P<{KIND_NAMES[kind]}>{pattern})' for kind, pattern in TOKEN_PATTERNS).encode())
+# Regex group index -> token kind
+GROUP_KINDS = {TOKEN_REGEX.groupindex[name]: kind for kind, name in enumerate(KIND_NAMES)}
 
 
-def build_lexer():
-    lg = LexerGenerator()
-    lg.add('META_VARIABLE', r'#[A-z]+')
+@dataclass
+class Tokens:
+    """
+    Lexed tokens stored as parallel arrays indexed by token position.
+    `values` is None for comments and newlines, and `numbers` is only set for
+    NUMBER and ADDRESS tokens.
+    """
+    kinds: array = field(default_factory=lambda: array('B'))
+    values: list[str | None] = field(default_factory=list)
+    numbers: list[int | None] = field(default_factory=list)
+    lines: array = field(default_factory=lambda: array('i'))
+    columns: array = field(default_factory=lambda: array('q'))
+
+    def __len__(self) -> int:
+        return len(self.kinds)
+
+
+class LexingError(Exception):
+    def __init__(self, line: int, column: int):
+        super().__init__(f'Unrecognized token at line {line+1}, column {column+1}.')
+        self.line = line
+        self.column = column
+
+
+def lex(source_code: bytes | mmap.mmap) -> Tokens:
+    """
+    Lexes raw source bytes. Only token values are decoded, and the token list
+    always ends in a newline even if the source does not.
+
+    Raises:
+        LexingError: If an unrecognized character is found
+    """
+    tokens = Tokens()
+    kinds, values, numbers, lines, columns = tokens.kinds, tokens.values, tokens.numbers, tokens.lines, tokens.columns
+
+    line = 0
+    line_start = 0
+    for match in TOKEN_REGEX.finditer(source_code):
+        kind = GROUP_KINDS[match.lastindex]
+        if kind == KIND_WHITESPACE:
+            continue
+
+        column = match.start()-line_start
+        if kind == KIND_UNKNOWN:
+            raise LexingError(line, column)
+
+        # Names are interned so dict lookups against instruction, meta variable
+        # and label names can short circuit on identity. Numeric values are
+        # parsed once here so the assembler only has to range check them.
+        value = None
+        number = None
+        if kind == KIND_NAME:
+            value = sys.intern(match.group().decode('ascii'))
+        elif kind == KIND_ADDRESS:
+            value = match.group().decode('ascii')
+            number = int(value[1:])
+        elif kind == KIND_NUMBER:
+            value = match.group().decode('ascii')
+            number = int(value)
+        elif kind == KIND_LABEL_NAME:
+            value = sys.intern(match.group()[:-1].decode('ascii'))
+        elif kind == KIND_META_VARIABLE:
+            value = sys.intern(match.group()[1:].decode('ascii'))
+        elif kind == KIND_DATA_ENTRY:
+            value = match.group().decode('utf-8')
+
+        kinds.append(kind)
+        values.append(value)
+        numbers.append(number)
+        lines.append(line)
+        columns.append(column)
+
+        if kind == KIND_NEWLINE:
+            line += 1
+            line_start = match.end()
+        elif kind == KIND_DATA_ENTRY:
+            # The whitespace between data entry fields can span lines
+            entry = match.group()
+            newline_count = entry.count(b'\n')
+            if newline_count:
+                line += newline_count
+                line_start = match.start() + entry.rfind(b'\n') + 1
+
+    if not kinds or kinds[-1] != KIND_NEWLINE:
+        kinds.append(KIND_NEWLINE)
+        values.append(None)
+        numbers.append(None)
+        lines.append(line)
+        columns.append(len(source_code)-line_start)
+    
+    return tokens
 
-    lg.add('NUMBER', r'-?\d+')
-    lg.add('ADDRESS', r'\$\d+')
-    lg.add('LABEL_NAME', r'[A-z0-9_]+:')
-    lg.add('NAME', r'[A-z_][A-z0-9_]*')
 
-    lg.add('DATA_ENTRY', DATA_ENTRY_REGEX)
+def _dump_json_stdlib(value) -> bytes:
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
 
-    lg.add('COMMENT', r';.*')
-    lg.add('NEWLINE', r'\n')
-    lg.ignore(r' ')
-    
-    return lg.build()
+
+# orjson is optional. It already emits compact JSON as bytes and is much faster on large instruction lists.
+dump_json = orjson.dumps if orjson is not None else _dump_json_stdlib
+
+
+class SourceLines:
+    """
+    Line access into the source code. Lines are only needed for error and
+    warning messages, so line offsets are indexed on first access instead of
+    splitting the whole source up front.
+    """
+    def __init__(self, source_code: bytes | mmap.mmap):
+        self.source_code = source_code
+        self.line_starts: array | None = None
+
+    def raw_line(self, line_number: int) -> bytes:
+        if self.line_starts is None:
+            self.line_starts = array('q', [0])
+            self.line_starts.extend(m.end() for m in re.finditer(b'\n', self.source_code))
+        
+        start = self.line_starts[line_number]
+        if line_number+1 < len(self.line_starts):
+            return self.source_code[start:self.line_starts[line_number+1]-1]
+        return self.source_code[start:]
+
+    def __getitem__(self, line_number: int) -> str:
+        return self.raw_line(line_number).decode('utf-8', errors='replace').rstrip('\r')
+
+    def character_column(self, line_number: int, column: int) -> int:
+        """
+        Converts a byte offset into a line to a character offset.
+        """
+        return len(self.raw_line(line_number)[:column].decode('utf-8', errors='replace'))
+
+    def to_list(self) -> list[str]:
+        return str(self.source_code, 'utf-8', errors='replace').replace('\r\n', '\n').split('\n')
 
 
 class AssemblerState(Enum):
@@ -65,16 +225,11 @@ class AssemblerState(Enum):
     SUBROUTINES = 3
 
 
-@dataclass
-class Instruction:
-    name: str
-    arguments: list[Token]
-    line_number: int
-
-
 @dataclass
 class ParsedInstruction:
     name: str
+    opcode: int
+    is_assignment: bool
     arguments: list[int | str]
     line_number: int
 
@@ -94,17 +249,23 @@ class DataEntry:
 
 
 class Assembler:
-    def __init__(self, tokens: LexerStream, source_lines: list[str]):
-        self.tokens = tokens
-        self.source_lines = source_lines
+    def __init__(self, source_code: bytes | mmap.mmap, optimize: bool=False):
+        self.source_code = source_code
+        self.optimize = optimize
+        self.source_lines = SourceLines(source_code)
+        self.tokens = Tokens()
+        self.token_index: int = 0
 
         self.state = AssemblerState.META_VARS
-        self.current_token = None
+        self.current_index: int = 0
 
         self.meta_vars = DEFAULT_META_VARS.copy()
         self.labels: dict[str, int] = {}
-        self.instruction_index: int = 0
-        self.instructions: list[Instruction] = []
+        # Label arguments awaiting resolution, stored as parallel arrays
+        self.pending_label_names: list[str] = []
+        self.pending_label_instructions = array('i')
+        self.pending_label_args = array('B')
+        self.pending_label_tokens = array('i')
 
         self.parsed_instructions: list[ParsedInstruction] = []
         self.start_label: int = -1
@@ -112,83 +273,52 @@ class Assembler:
         self.data_entries: list[DataEntry] = []
 
 
-    def error(self, message: str, token: Token | None=None):
-        if token is None:
-            token = self.current_token
-        
-        line_number = token.source_pos.lineno-1
-        column_number = token.source_pos.colno-1
+    def print_source_location(self, line: int, column: int):
+        line_prefix = f'{line+1} | '
+        print(f'{line_prefix}{self.source_lines[line]}')
+        print(f'{" " * (len(line_prefix)+self.source_lines.character_column(line, column))}^')
+
+
+    def error_at(self, message: str, line: int, column: int):
         print(f'{COLOR_ERROR}ASSEMBLER ERROR: {message}')
-        print(f'{line_number+1} | {self.source_lines[line_number]}')
-        print(f'{" " * (len(str(line_number))+3+column_number)}^')
+        self.print_source_location(line, column)
         print(COLOR_RESET, end='')
 
         sys.exit()
     
 
-    def warning(self, message: str, token: Token | None=None):
-        if token is None:
-            token = self.current_token
+    def error(self, message: str, token_index: int | None=None):
+        if token_index is None:
+            token_index = self.current_index
+        self.error_at(message, self.tokens.lines[token_index], self.tokens.columns[token_index])
+    
+
+    def warning(self, message: str, token_index: int | None=None):
+        if token_index is None:
+            token_index = self.current_index
         
-        line_number = token.source_pos.lineno-1
-        column_number = token.source_pos.colno-1
         print(f'{COLOR_WARN}ASSEMBLER WARNING: {message}')
-        print(f'{line_number+1} | {self.source_lines[line_number]}')
-        print(f'{" " * (len(str(line_number))+3+column_number)}^')
+        self.print_source_location(self.tokens.lines[token_index], self.tokens.columns[token_index])
         print(COLOR_RESET, end='')
     
 
-    def next_token(self, token_name: str):
-        try:
-            next_tok = self.tokens.next()
-        except StopIteration:
-            self.error(f'Reached end of token stream while trying to get token "{token_name}"')
+    def next_token(self, kind: int) -> int:
+        if self.token_index >= len(self.tokens):
+            self.error(f'Reached end of token stream while trying to get token "{KIND_NAMES[kind]}"')
         
-        if next_tok.name != token_name:
-            self.error(next_tok, f'Expected "{token_name}" token but got "{next_tok.name}"')
-        
-        return next_tok
-
-    def get_until_newline(self) -> list[Token]:
-        returned_tokens = []
-        while True:
-            token = self.tokens.next()
-            if token.name == 'COMMENT':
-                continue
-            if token.name == 'NEWLINE':
-                break
-            returned_tokens.append(token)
-        return returned_tokens
-
-    def parse_argument_token(self, token: Token) -> str | int:
-        if token.name == 'NUMBER':
-            parsed = int(token.value)
-            if parsed < INT_RANGE_LOWER or parsed > INT_RANGE_UPPER:
-                self.error(f'Integer value {token.value} is outside the 32 bit signed integer range.', token)
-            return parsed
+        next_index = self.token_index
+        self.token_index += 1
+        next_kind = self.tokens.kinds[next_index]
+        if next_kind != kind:
+            self.error(f'Expected "{KIND_NAMES[kind]}" token but got "{KIND_NAMES[next_kind]}"', next_index)
         
-        elif token.name == 'NAME':
-            if token.value not in self.labels:
-                self.error(f'Undefined label "{token.value}".', token)
-            return self.labels[token.value]
-
-        elif token.name == 'ADDRESS':
-            parsed_address = int(token.value[1:])
-            if parsed_address < INT_RANGE_LOWER or parsed_address > INT_RANGE_UPPER:
-                self.error(f'Address value {token.value} is outside the 32 bit signed integer range.', token)
-            return token.value
-
-        return token.value
+        return next_index
 
 
     def check_misplaced_meta_var(self):
-        if self.current_token.name == 'META_VARIABLE':
+        if self.tokens.kinds[self.current_index] == KIND_META_VARIABLE:
             self.error(f'Got a misplaced meta variable.')
     
-    def check_misplaced_data_entry(self):
-        if self.current_token.name == 'DATA_ENTRY':
-            self.error(f'Got a misplaced data entry.')
-    
 
     def check_data_entry_spans(self):
         spans = [[e.address, e.address+len(e.data)-1] for e in self.data_entries]
@@ -200,44 +330,97 @@ class Assembler:
                     self.warning(f'Data overlap found between {spans[i]} and {spans[j]}.')
     
 
-    def parse_instruction_args(self):
-        for instruction in self.instructions:
-            parsed_args = [self.parse_argument_token(t) for t in instruction.arguments]
-            first_argument = parsed_args[0]
-            if instruction.name in ASSIGNMENT_INSTRUCTIONS and isinstance(first_argument, int) and first_argument <= 11:
-                self.warning('Assignment to a reserved memory location.', parsed_args[0])
+    def resolve_labels(self):
+        labels = self.labels
+        names = self.pending_label_names
+        if not labels.keys() >= set(names):
+            k = next(k for k, name in enumerate(names) if name not in labels)
+            self.error(f'Undefined label "{names[k]}".', self.pending_label_tokens[k])
+        
+        resolved = list(map(labels.__getitem__, names))
+        instructions = self.parsed_instructions
+        for instruction_index, arg_index, label_index, token_index in zip(self.pending_label_instructions, self.pending_label_args, resolved, self.pending_label_tokens):
+            instruction = instructions[instruction_index]
+            instruction.arguments[arg_index] = label_index
+            if arg_index == 0 and instruction.is_assignment and label_index <= 11:
+                self.warning('Assignment to a reserved memory location.', token_index)
+    
+
+    def peephole_optimize(self):
+        """
+        Removes self moves (`mov N $N`) and rewrites arithmetic by an identity operand as a `mov`.
+
+        Labels and label arguments are remapped to the new instruction indices.
+        Jump targets that are not labels can't be remapped, so a warning is
+        printed for each of them if any instructions were removed.
+        """
+        label_refs = set(zip(self.pending_label_instructions, self.pending_label_args))
+        mov_opcode = INSTRUCTION_INFO['mov'][0]
+
+        optimized_instructions: list[ParsedInstruction] = []
+        # Old instruction index -> index of the next kept instruction
+        index_remap: list[int] = []
+        for i, instruction in enumerate(self.parsed_instructions):
+            index_remap.append(len(optimized_instructions))
+            name = instruction.name
+            arguments = instruction.arguments
+
+            # A literal destination is an address, so `mov N $N` copies an address onto itself.
+            # `$N` destinations are indirect and label destinations can move, so neither is a self move.
+            if name == 'mov' and isinstance(arguments[0], int) and (i, 0) not in label_refs and arguments[1] == f'${arguments[0]}':
+                continue
+            
+            identity_operand = IDENTITY_OPERANDS.get(name)
+            if identity_operand is not None and arguments[2] == identity_operand and (i, 2) not in label_refs:
+                instruction = ParsedInstruction('mov', mov_opcode, True, arguments[:2], instruction.line_number)
+            
+            optimized_instructions.append(instruction)
+        index_remap.append(len(optimized_instructions))
 
-            self.parsed_instructions.append(
-                ParsedInstruction(
-                    instruction.name, parsed_args, instruction.line_number
-                )
-            )
+        self.parsed_instructions = optimized_instructions
+        if len(optimized_instructions) == len(index_remap)-1:
+            return
+        
+        self.labels = {name: index_remap[index] for name, index in self.labels.items()}
+        for instruction_index, arg_index in label_refs:
+            arguments = optimized_instructions[index_remap[instruction_index]].arguments
+            arguments[arg_index] = index_remap[arguments[arg_index]]
+        
+        remapped_jumps = {index_remap[i] for i, j in label_refs if j == 0}
+        for i, instruction in enumerate(optimized_instructions):
+            if instruction.name == 'jmp' and i not in remapped_jumps:
+                print(f'{COLOR_WARN}WARNING: Jump on line {instruction.line_number+1} does not target a label and may no longer reach the intended instruction after optimization.{COLOR_RESET}')
 
 
     def assemble_meta_vars(self):
-        if self.current_token.name == 'META_VARIABLE':
-            meta_variable_name = self.current_token.value[1:]
+        kind = self.tokens.kinds[self.current_index]
+        if kind == KIND_META_VARIABLE:
+            meta_variable_name = self.tokens.values[self.current_index]
             if meta_variable_name not in DEFAULT_META_VARS:
                 self.error(f'Unrecognized meta variable "{meta_variable_name}".')
             
-            value_token = self.next_token('NUMBER')
-            self.meta_vars[meta_variable_name] = int(value_token.value)
+            value_index = self.next_token(KIND_NUMBER)
+            value = self.tokens.numbers[value_index]
+            if not INT_RANGE_LOWER <= value <= INT_RANGE_UPPER:
+                self.error(f'Integer value {self.tokens.values[value_index]} is outside the 32 bit signed integer range.', value_index)
+            self.meta_vars[meta_variable_name] = value
         
-        elif self.current_token.name == 'DATA_ENTRY':
+        elif kind == KIND_DATA_ENTRY:
             self.state = AssemblerState.DATA
 
-        elif self.current_token.name == 'LABEL_NAME':
+        elif kind == KIND_LABEL_NAME:
             self.state = AssemblerState.SUBROUTINES
         
         else:
-            self.error(f'Expected meta variable definition but got "{self.current_token.name}".')
+            self.error(f'Expected meta variable definition but got "{KIND_NAMES[kind]}".')
 
 
     def assemble_data_entries(self):
         self.check_misplaced_meta_var()
 
-        if self.current_token.name == 'DATA_ENTRY':
-            entry_string = self.current_token.value
+        kind = self.tokens.kinds[self.current_index]
+        if kind == KIND_DATA_ENTRY:
+            entry_string = self.tokens.values[self.current_index]
             entry_match = re.match(DATA_ENTRY_REGEX, entry_string)
 
             address = int(entry_match.group(1))
@@ -257,65 +440,135 @@ class Assembler:
                 address, entry_data
             ))
 
-        elif self.current_token.name == 'LABEL_NAME':
+        elif kind == KIND_LABEL_NAME:
             self.state = AssemblerState.SUBROUTINES
 
         else:
-            self.error(f'Expected data entry but got "{self.current_token.name}".')
+            self.error(f'Expected data entry but got "{KIND_NAMES[kind]}".')
 
     
     def assemble_subroutines(self):
-        self.check_misplaced_meta_var()
-        self.check_misplaced_data_entry()
+        """
+        Assembles everything from the first label to the end of the program.
+        This is the hot loop for typical programs, so it walks the token arrays
+        with local variables only and leaves the assembler state to the error
+        paths. Label arguments are recorded for resolve_labels.
+        """
+        kinds, values, numbers, lines = self.tokens.kinds, self.tokens.values, self.tokens.numbers, self.tokens.lines
+        labels = self.labels
+        instructions = self.parsed_instructions
+        pending_names = self.pending_label_names
+        pending_instructions = self.pending_label_instructions
+        pending_args = self.pending_label_args
+        pending_tokens = self.pending_label_tokens
+
+        i = self.current_index
+        token_count = len(kinds)
+        while i < token_count:
+            kind = kinds[i]
+            if kind == KIND_NEWLINE or kind == KIND_COMMENT:
+                i += 1
+                continue
 
-        if self.current_token.name == 'LABEL_NAME':
-            label_name = self.current_token.value[:-1]
-            if label_name in self.labels:
-                self.warning(f'Label "{label_name}" declared more than once.')
-            else:
-                self.labels[label_name] = self.instruction_index
-        
-        elif self.current_token.name == 'NAME':
-            instruction_name = self.current_token.value
-            if instruction_name not in INSTRUCTIONS:
-                self.error(f'Unrecognized instruction "{instruction_name}".')
-
-            instruction_arg_amount = ARGUMENT_COUNT_LOOKUP[instruction_name]
-            instruction_args = self.get_until_newline()
-            if len(instruction_args) != instruction_arg_amount:
-                self.error(f'Expected {instruction_arg_amount} argument(s) for instruction "{instruction_name}" but got {len(instruction_args)}.')
+            if kind == KIND_LABEL_NAME:
+                label_name = values[i]
+                if label_name in labels:
+                    self.warning(f'Label "{label_name}" declared more than once.', i)
+                else:
+                    labels[label_name] = len(instructions)
+                i += 1
+            
+            elif kind == KIND_NAME:
+                instruction_name = values[i]
+                instruction_info = INSTRUCTION_INFO.get(instruction_name)
+                if instruction_info is None:
+                    self.error(f'Unrecognized instruction "{instruction_name}".', i)
+                opcode, instruction_arg_amount, is_assignment = instruction_info
+
+                # Arguments run until the newline. Comments run until the end of the line, so one can only be the last token
+                arg_start = i+1
+                newline_index = kinds.index(KIND_NEWLINE, arg_start)
+                arg_end = newline_index
+                if arg_end > arg_start and kinds[arg_end-1] == KIND_COMMENT:
+                    arg_end -= 1
+                if arg_end-arg_start != instruction_arg_amount:
+                    self.error(f'Expected {instruction_arg_amount} argument(s) for instruction "{instruction_name}" but got {arg_end-arg_start}.', i)
+
+                parsed_args = []
+                for j in range(arg_start, arg_end):
+                    arg_kind = kinds[j]
+                    if arg_kind == KIND_NUMBER:
+                        if not INT_RANGE_LOWER <= numbers[j] <= INT_RANGE_UPPER:
+                            self.error(f'Integer value {values[j]} is outside the 32 bit signed integer range.', j)
+                        parsed_args.append(numbers[j])
+                    
+                    elif arg_kind == KIND_ADDRESS:
+                        if not INT_RANGE_LOWER <= numbers[j] <= INT_RANGE_UPPER:
+                            self.error(f'Address value {values[j]} is outside the 32 bit signed integer range.', j)
+                        parsed_args.append(values[j])
+                    
+                    elif arg_kind == KIND_NAME:
+                        # Labels can be declared after they are used, so these get filled in by resolve_labels
+                        pending_names.append(values[j])
+                        pending_instructions.append(len(instructions))
+                        pending_args.append(j-arg_start)
+                        pending_tokens.append(j)
+                        parsed_args.append(PENDING_LABEL)
+                    
+                    else:
+                        parsed_args.append(values[j])
+
+                # Only number literals are known here, label arguments are checked in resolve_labels
+                if is_assignment and kinds[arg_start] == KIND_NUMBER and parsed_args[0] <= 11:
+                    self.warning('Assignment to a reserved memory location.', arg_start)
+
+                instructions.append(ParsedInstruction(instruction_name, opcode, is_assignment, parsed_args, lines[i]))
+                i = newline_index+1
+            
+            elif kind == KIND_META_VARIABLE:
+                self.error('Got a misplaced meta variable.', i)
             
-            self.instructions.append(
-                Instruction(
-                    instruction_name, instruction_args, 
-                    self.current_token.source_pos.lineno-1
-                )
-            )
-            self.instruction_index += 1
+            elif kind == KIND_DATA_ENTRY:
+                self.error('Got a misplaced data entry.', i)
 
-        else:
-            self.error(f'Expected label name or instruction name but got "{self.current_token.name}"')
+            else:
+                self.error(f'Expected label name or instruction name but got "{KIND_NAMES[kind]}"', i)
+        
+        self.token_index = i
+        self.current_index = i-1
 
     def assemble(self):
         try:
-            for self.current_token in self.tokens:
-                if self.current_token.name in {'NEWLINE', 'COMMENT'}:
-                    continue
-
-                if self.state == AssemblerState.META_VARS:
-                    self.assemble_meta_vars()
-                
-                if self.state == AssemblerState.DATA:
-                    self.assemble_data_entries()
-
-                if self.state == AssemblerState.SUBROUTINES:
-                    self.assemble_subroutines()
+            # Tokens always end in a newline so instruction arguments never run off the end
+            self.tokens = lex(self.source_code)
+        except LexingError as e:
+            self.error_at('Unrecognized token.', e.line, e.column)
         
-        except LexingError:
-            self.error('Unrecognized token.')
+        kinds = self.tokens.kinds
+        while self.token_index < len(kinds):
+            self.current_index = self.token_index
+            self.token_index += 1
+            kind = kinds[self.current_index]
+            if kind == KIND_NEWLINE or kind == KIND_COMMENT:
+                continue
+
+            if self.state == AssemblerState.META_VARS:
+                self.assemble_meta_vars()
+            
+            if self.state == AssemblerState.DATA:
+                self.assemble_data_entries()
+
+            if self.state == AssemblerState.SUBROUTINES:
+                # Consumes the rest of the tokens
+                self.assemble_subroutines()
         
         self.check_data_entry_spans()
-        self.parse_instruction_args()
+        # Programs that never reference a label are already fully parsed
+        if self.pending_label_names:
+            self.resolve_labels()
+        
+        if self.optimize:
+            self.peephole_optimize()
 
         # Check for start and tick labels
         if 'tick' in self.labels:
@@ -327,24 +580,33 @@ class Assembler:
             self.start_label = self.labels['start']
 
 
-    def assemble_json(self, include_source: bool) -> bytes:
-        output_json = {
-            'meta': self.meta_vars,
-            'instructions': [i.to_json(include_source) for i in self.parsed_instructions]
-        }
+    def write_json(self, f: BinaryIO, include_source: bool):
+        """
+        Streams the JSON output to `f` one instruction at a time instead of
+        building the whole document in memory first.
+        """
+        f.write(b'{"meta":')
+        f.write(dump_json(self.meta_vars))
+
+        f.write(b',"instructions":[')
+        for i, instruction in enumerate(self.parsed_instructions):
+            if i:
+                f.write(b',')
+            f.write(dump_json(instruction.to_json(include_source)))
+        f.write(b']')
 
         if self.start_label != -1:
-            output_json['start'] = self.start_label
+            f.write(b',"start":' + dump_json(self.start_label))
         if self.tick_label != -1:
-            output_json['tick'] = self.tick_label
+            f.write(b',"tick":' + dump_json(self.tick_label))
         
         if self.data_entries:
-            output_json['data'] = [e.to_json() for e in self.data_entries]
+            f.write(b',"data":' + dump_json([e.to_json() for e in self.data_entries]))
         
         if include_source:
-            output_json['source'] = self.source_lines
+            f.write(b',"source":' + dump_json(self.source_lines.to_list()))
         
-        return json.dumps(output_json, separators=(',', ':')).encode('utf-8')
+        f.write(b'}')
 
     
     def assemble_binary(self) -> bytes:
@@ -357,7 +619,6 @@ class Assembler:
 
         formatted_instructions = []
         for instruction in self.parsed_instructions:
-            instruction_name = instruction.name
             arguments = instruction.arguments
 
             formatted_arguments = []
@@ -366,9 +627,8 @@ class Assembler:
                     formatted_arguments.append({'type': ARG_TYPE_LITERAL, 'value': argument})
                 else:
                     formatted_arguments.append({'type': ARG_TYPE_ADDRESS, 'value': int(argument[1:])})
-            instruction_opcode = OPCODE_LOOKUP[instruction_name]
             verbose_instruction = {
-                'opcode': instruction_opcode,
+                'opcode': instruction.opcode,
                 'arguments': formatted_arguments
             }
             formatted_instructions.append(verbose_instruction)
@@ -390,28 +650,53 @@ class Assembler:
         return G1BinaryFormat.build(file_dict)
 
 
-def assemble(input_path: str, output_path: str, include_source: bool, output_format: OUTPUT_FORMATS):
+def map_file(f: BinaryIO):
+    """
+    Memory maps `f` for reading so the source is never copied into a string.
+    Empty files can't be mapped, so those give empty bytes instead.
+    """
+    if os.fstat(f.fileno()).st_size == 0:
+        return nullcontext(b'')
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_file(output_path: str, content: bytes):
+    """
+    Writes `content` straight to a file descriptor, skipping the copy into a
+    buffered writer for large single payloads.
+    """
+    fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+    try:
+        view = memoryview(content)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
+
+def assemble(input_path: str, output_path: str, include_source: bool, output_format: OUTPUT_FORMATS, optimize: bool=False):
     if not os.path.isfile(input_path):
         raise FileNotFoundError(f'File "{input_path}" does not exist.')
-    with open(input_path, 'r') as f:
-        source_code = f.read()
-    
-    source_lines = source_code.split('\n')
-    lexer = build_lexer()
-    tokens = lexer.lex(source_code + '\n')
-
-    assembler = Assembler(tokens, source_lines)
-    assembler.assemble()
-
-    # Set file content based on the output format
-    if output_format == 'json':
-        file_content = assembler.assemble_json(include_source)
-    else:
-        file_content = assembler.assemble_binary()
-    
-    # Write the output file
-    with open(output_path, 'wb') as f:
-        f.write(file_content)
+    with open(input_path, 'rb') as f, map_file(f) as source_code:
+        assembler = Assembler(source_code, optimize)
+        assembler.assemble()
+
+        # Write the output file based on the output format
+        if output_format == 'json':
+            # JSON is streamed in many small pieces, which is what the buffered writer is for.
+            # It goes to a temporary file first so a failed write can't leave a truncated output.
+            temp_path = f'{output_path}.tmp'
+            try:
+                with open(temp_path, 'wb') as output_file:
+                    assembler.write_json(output_file, include_source)
+                os.replace(temp_path, output_path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        else:
+            write_file(output_path, assembler.assemble_binary())
 
 
 def main():
@@ -421,6 +706,7 @@ def main():
         parser.add_argument('output_path', help='The path to the assembled g1 program')
         parser.add_argument('--include_source', '-src', action='store_true', help='Include the source lines in the assembled program. Only works if the output format is .json')
         parser.add_argument('--output_format', '-o', default=None, choices=['g1b', 'json'], help='The output format for the assembled program')
+        parser.add_argument('--optimize', '-opt', action='store_true', help='Remove no-op instructions. This changes instruction indices, so only jumps that target labels are guaranteed to stay correct')
         args = parser.parse_args()
     except Exception as e:
         print(e)
@@ -439,7 +725,7 @@ def main():
         else:
             output_format = DEFAULT_OUTPUT_FORMAT
     
-    assemble(args.input_path, args.output_path, args.include_source, output_format)
+    assemble(args.input_path, args.output_path, args.include_source, output_format, args.optimize)
     return 0
 
 
@@ -2,3 +2,5 @@ INSTRUCTIONS = ['mov', 'movp', 'add', 'sub', 'mul', 'div', 'mod', 'less', 'equal
 ARGUMENT_COUNTS = [2, 2, 3, 3, 3, 3, 3, 3, 3, 2, 2, 3, 2, 4, 4, 1, 3, 4]
 ARGUMENT_COUNT_LOOKUP = {i: c for i, c in zip(INSTRUCTIONS, ARGUMENT_COUNTS)}
 ASSIGNMENT_INSTRUCTIONS = {'mov', 'movp', 'add', 'sub', 'mul', 'div', 'mod', 'less', 'equal', 'not', 'getp'}
+INSTRUCTION_INFO = {name: (i, ARGUMENT_COUNT_LOOKUP[name], name in ASSIGNMENT_INSTRUCTIONS) for i, name in enumerate(INSTRUCTIONS)}
+IDENTITY_OPERANDS = {'add': 0, 'sub': 0, 'mul': 1, 'div': 1}
@@ -0,0 +1,51 @@
+from g1asm.assembler import Assembler
+
+
+def optimize(source: str) -> Assembler:
+    assembler = Assembler(source.encode(), optimize=True)
+    assembler.assemble()
+    return assembler
+
+
+def instruction_listing(assembler: Assembler) -> list[tuple]:
+    return [(instruction.name, *instruction.arguments) for instruction in assembler.parsed_instructions]
+
+
+def test_removes_self_move():
+    assembler = optimize('tick:\n  mov 20 $20\n  mov 21 $20\n')
+    assert instruction_listing(assembler) == [('mov', 21, '$20')]
+
+
+def test_keeps_indirect_move():
+    assembler = optimize('tick:\n  mov $20 $20\n')
+    assert instruction_listing(assembler) == [('mov', '$20', '$20')]
+
+
+def test_keeps_move_between_different_addresses():
+    assembler = optimize('tick:\n  mov 20 $21\n  mov 20 20\n')
+    assert instruction_listing(assembler) == [('mov', 20, '$21'), ('mov', 20, 20)]
+
+
+def test_keeps_label_destination():
+    assembler = optimize('tick:\n  mov tick $0\n')
+    assert instruction_listing(assembler) == [('mov', 0, '$0')]
+
+
+def test_rewrites_identity_operand():
+    assembler = optimize('tick:\n  add 20 $21 0\n  mul 20 $21 1\n  sub 20 $21 1\n')
+    assert instruction_listing(assembler) == [
+        ('mov', 20, '$21'),
+        ('mov', 20, '$21'),
+        ('sub', 20, '$21', 1)
+    ]
+
+
+def test_remaps_labels():
+    assembler = optimize('start:\n  mov 20 $20\ntick:\n  mov 20 $20\n  jmp tick 1\n')
+    assert assembler.labels == {'start': 0, 'tick': 0}
+    assert instruction_listing(assembler) == [('jmp', 0, 1)]
+
+
+def test_warns_on_literal_jump(capsys):
+    optimize('tick:\n  mov 20 $20\n  jmp 0 1\n')
+    assert 'does not target a label' in capsys.readouterr().out